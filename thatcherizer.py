@@ -13,14 +13,17 @@ import traceback
 from os.path import splitext, join, isfile
 from subprocess import call
 import math
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor, Future
 import numpy as np
 import pygame
 import Image
 from thatcherizerTools import *
+from thatcherizerEngine import ThatcherizerEngine
 
 ##### CONFIG VARS ##########################################
 # dirs
-thatcherDir = os.path.abspath(os.path.dirname(sys.argv[0]))
+thatcherDir = os.path.abspath(os.path.dirname(__file__))
 outputDir = join(thatcherDir, 'output')
 stimsDir = join(thatcherDir, 'stims')
 for d in [outputDir, stimsDir]:
@@ -44,13 +47,13 @@ ltBlue  = (108,190,220)
 camResolution = (640,480)		# specify resolution of the camera
 imgCenterX, imgCenterY = camResolution[0]/2, camResolution[1]/2
 
-useCamera = True
-if useCamera:
-	camStream = PiCamStream(camResolution, fps)
-	camStream.start()
-else:
-	dummyImage = Image.open(join(stimsDir,"tmp2.jpg"))
-	dummyImage = np.array(dummyImage)
+cameraSource = 'picamera'		# 'picamera', 'opencv[:device]', or a directory of images/video file to replay (can also be given as the 1st command line arg)
+
+# live feature tracking (shows the detected features on the live stream, and seeds the confirm step with them)
+useTracking = False
+trackEveryNthFrame = 3			# run detection on (at most) every Nth preview frame
+trackBudget = 0.5				# max average fraction of each frame interval detection may use
+featureTracker = None
 
 # initialize misc
 pygame.font.init()
@@ -66,7 +69,15 @@ printBg = pygame.image.load(join(stimsDir, 'printBg.png'))
 # load stims
 headGuide = pygame.image.load(join(stimsDir, 'headGuide.png'))
 headGuide = pygame.transform.scale(headGuide, viewerSize)
-mask = Image.open(join(stimsDir, "alphaMask.png"))
+
+# reused surface for showing the live camera stream in the viewer
+cameraPreview = CameraPreview(viewerSize)
+
+# headless engine that does the actual thatcherizing/compositing
+engine = ThatcherizerEngine(join(stimsDir, "alphaMask.png"), join(stimsDir, "printTemplates", "printTemplate.png"))
+
+# background worker for feature detection (single thread, so it only loads the classifiers once)
+detectionPool = ThreadPoolExecutor(max_workers=1)
 
 
 
@@ -112,8 +123,10 @@ def run_thatcherizer(width, height, fps, starting_state):
 				# clean quit, when asked
 				if killNow:
 					activeState.Terminate()
-					if useCamera:
-						camStream.stop()
+					camStream.stop()
+					detectionPool.shutdown(wait=False)
+					if featureTracker is not None:
+						featureTracker.stop()
 					pygame.quit()
 				else:
 					# otherwise append the event to the list and pass along to the state
@@ -138,8 +151,10 @@ def run_thatcherizer(width, height, fps, starting_state):
 			print exc_type
 			print exc_val
 			activeState.Terminate()
-			if useCamera:
-				camStream.stop()
+			camStream.stop()
+			detectionPool.shutdown(wait=False)
+			if featureTracker is not None:
+				featureTracker.stop()
 			pygame.quit()
 			raise SystemExit
 
@@ -204,6 +219,14 @@ class thatchLiveStream(StateBase):
 		self.takePhotoButton = Button("take photo", 700, 241, 62, upColor=white, fontColor=bgBlue, fontSize=20)
 		self.theseButtons = [self.resetButton, self.takePhotoButton]
 
+		# last camera frame shown
+		self.frameSeq = 0
+		self.cameraFrame = None
+
+		# start tracking from scratch for each new guest
+		if featureTracker is not None:
+			featureTracker.reset()
+
 	def ProcessInput(self,eventList):
 		# look for button clicks in the event list
 		for event in eventList:
@@ -216,24 +239,30 @@ class thatchLiveStream(StateBase):
 			if 'click' in retVal: self.SwitchToState(thatchTakePhoto())
 
 	def Update(self):
-		# update the camera stream
-		if useCamera:
-			self.cameraFrame = camStream.read()											# get current frame
-		else: 
-			self.cameraFrame = dummyImage
-		self.cameraImg = pygame.surfarray.make_surface(np.rot90(self.cameraFrame))	# convert to pygame surface (must rotate!)
-		self.croppedImgRect = cropImage(self.cameraImg, viewerSize)
+		# update the camera stream (only when there's a new frame)
+		newFrame = readCameraFrame(self.frameSeq)
+		if newFrame is not None:
+			self.frameSeq, self.cameraFrame = newFrame
+			cameraPreview.update(self.cameraFrame)										# copy the viewer window into the preview surface
+
+			# hand the frame to the feature tracker
+			if featureTracker is not None:
+				featureTracker.submit(self.cameraFrame)
 
 	def Render(self, screen):
 		# draw the background
 		screen.blit(takePhotoBg, (0,0))
 
 		# show camera stream
-		screen.blit(self.cameraImg, (centerX-(viewerSize[0]/2), centerY-(viewerSize[1]/2)), self.croppedImgRect)
+		screen.blit(cameraPreview.surface, (centerX-(viewerSize[0]/2), centerY-(viewerSize[1]/2)))
 
 		# show head guide
 		screen.blit(headGuide, ( (centerX-(headGuide.get_rect().size[0]/2)), (centerY-(headGuide.get_rect().size[1]/2)) ))
 
+		# show the tracked features
+		if featureTracker is not None:
+			drawTrackedFeatures(screen)
+
 		# render button states
 		for button in self.theseButtons:
 			button.draw(screen)
@@ -248,6 +277,10 @@ class thatchTakePhoto(StateBase):
 		self.countdown = 3
 		self.frameCount = 0
 
+		# last camera frame shown
+		self.frameSeq = 0
+		self.cameraFrame = None
+
 		# initialize text
 		self.countdownFont = pygame.font.Font('freesansbold.ttf', 85)
 
@@ -258,13 +291,15 @@ class thatchTakePhoto(StateBase):
 	def Update(self):
 		# check if countdown has elapsed
 		if self.countdown > 0:
-			# update the camera stream
-			if useCamera:
-				self.cameraFrame = camStream.read()											# get current frame
-			else: 
-				self.cameraFrame = dummyImage								
-			self.cameraImg = pygame.surfarray.make_surface(np.rot90(self.cameraFrame))	
-			self.croppedImgRect = cropImage(self.cameraImg, viewerSize)
+			# update the camera stream (only when there's a new frame)
+			newFrame = readCameraFrame(self.frameSeq)
+			if newFrame is not None:
+				self.frameSeq, self.cameraFrame = newFrame
+				cameraPreview.update(self.cameraFrame)
+
+				# keep tracking through the countdown
+				if featureTracker is not None:
+					featureTracker.submit(self.cameraFrame)
 
 			# update the countdown
 			self.TextSurf, self.TextRect = text_objects(str(self.countdown), self.countdownFont, yellow)
@@ -274,8 +309,15 @@ class thatchTakePhoto(StateBase):
 			# reset countdown
 			self.countdown = 3
 
-			# switch to the next state
-			self.SwitchToState(thatchConfirmPhoto(self.cameraFrame, self.croppedImgRect))
+			# seed the features with the tracked ones, if the track is stable
+			seedRects = None
+			if featureTracker is not None:
+				trackedRects = featureTracker.get_stableRects()
+				if trackedRects is not None:
+					seedRects = [convertRect_image2screen(r) for r in trackedRects]
+
+			# switch to the next state (with a copy of the photo; camera frames get reused)
+			self.SwitchToState(thatchConfirmPhoto(self.cameraFrame.copy(), cameraPreview.cropRect, seedRects))
 
 		# update the counter
 		self.frameCount += 1
@@ -289,7 +331,7 @@ class thatchTakePhoto(StateBase):
 		screen.blit(takePhotoBg, (0,0))
 
 		# update the viewWindow
-		screen.blit(self.cameraImg, (centerX-(viewerSize[0]/2), centerY-(viewerSize[1]/2)), self.croppedImgRect)
+		screen.blit(cameraPreview.surface, (centerX-(viewerSize[0]/2), centerY-(viewerSize[1]/2)))
 
 		# show head guide
 		screen.blit(headGuide, ( (centerX-(headGuide.get_rect().size[0]/2)), (centerY-(headGuide.get_rect().size[1]/2)) ))
@@ -300,7 +342,8 @@ class thatchTakePhoto(StateBase):
 
 class thatchConfirmPhoto(StateBase):
 	""" Display the photo and ask for confirmation """
-	def __init__(self, cameraFrame, cropRect):
+	def __init__(self, cameraFrame, cropRect, seedRects=None):
+		""" seedRects: [left eye, right eye, mouth] rects (SCREEN COORDINATES) to use instead of running detection """
 		StateBase.__init__(self)				# inherit structure from app state template
 		
 		# load in photo & rect
@@ -318,29 +361,28 @@ class thatchConfirmPhoto(StateBase):
 		self.acceptButton = Button("use this!", 700, 241, 62, upColor=white, fontColor=bgBlue, fontSize=20)
 		self.theseButtons = [self.doOverButton, self.acceptButton]
 
+		# start detecting features in the background while the user looks at the photo (unless already tracked)
+		self.cancelDetection = Event()
+		if seedRects is not None:
+			self.featureFuture = Future()
+			self.featureFuture.set_result(seedRects)
+		else:
+			self.featureFuture = detectionPool.submit(detectFeatureRects, self.cameraFrame, self.cancelDetection)
+
 	def ProcessInput(self,eventList):
 		# look for button clicks in the event list
 		for event in eventList:
 			# reset button
 			retVal = self.doOverButton.handleEvent(event)
-			if 'click' in retVal: self.SwitchToState(thatchLiveStream())
+			if 'click' in retVal:
+				self.CancelDetection()
+				self.SwitchToState(thatchLiveStream())
 
 			# confirm this photo, button
 			retVal = self.acceptButton.handleEvent(event)
 			if 'click' in retVal:
-				# detect features in this photo
-				self.detectFeatures = FeatureRecognition(self.cameraFrame)		# create featureDetection object with this frame
-				self.eyeRects = self.detectFeatures.detectEyes()				# find the eyes in this image
-				self.mouthRect = self.detectFeatures.detectMouth()				# find the mouth in this image
-
-				# create feature objects for all features
-				self.leftEye = FacialFeature("left eye", convertRect_image2screen(self.eyeRects[0]))
-				self.rightEye = FacialFeature("right eye", convertRect_image2screen(self.eyeRects[1]))
-				self.mouth = FacialFeature("mouth", convertRect_image2screen(self.mouthRect))
-				self.features = [self.leftEye, self.rightEye, self.mouth]
-
-				# switch to confirm features state
-				self.SwitchToState(thatchConfirmFeatures(self.cameraFrame, self.cropRect, self.features))
+				# switch to confirm features state (it picks up the detected features once they're ready)
+				self.SwitchToState(thatchConfirmFeatures(self.cameraFrame, self.cropRect, self.featureFuture))
 
 	def Update(self):
 		# update the flash alpha level
@@ -365,31 +407,61 @@ class thatchConfirmPhoto(StateBase):
 		for button in self.theseButtons:
 			button.draw(screen)
 
+	def CancelDetection(self):
+		""" stop the background feature detection; its result will be thrown away """
+		self.cancelDetection.set()
+		self.featureFuture.cancel()
+
+	def Terminate(self):
+		self.CancelDetection()
+		StateBase.Terminate(self)
+
 
 class thatchConfirmFeatures(StateBase):
 	""" Confirm the selection of the eyes and mouth """
-	def __init__(self, cameraFrame, cropRect, featureList):
+	def __init__(self, cameraFrame, cropRect, featureFuture):
 		StateBase.__init__(self)
 
-		# load in the photo, crop rect, and feature list
+		# load in the photo, crop rect, and the (maybe still running) feature detection
 		self.cameraFrame = cameraFrame
 		self.cameraImg = pygame.surfarray.make_surface(np.rot90(self.cameraFrame))
 		self.cropRect = cropRect
+		self.featureFuture = featureFuture
 
-		# initialize features
-		self.featureList = featureList
+		# features get initialized once detection is done
+		self.featureList = None
 		self.featureIndex = 0
-		self.currentFeature = self.featureList[self.featureIndex]
 
 		# initialize the text
 		self.labelText = pygame.font.Font('freesansbold.ttf', 38)
-		self.textSurf, self.textRect = text_objects(self.currentFeature.label, self.labelText, ltBlue)
+		self.textSurf, self.textRect = text_objects("wait...", self.labelText, ltBlue)
 		self.textRect.center = (700, 115)
 
 		# initialize buttons
 		self.nextButton = Button("next", 700, 241, 62, upColor=white, fontColor=bgBlue, fontSize=30)
 
+	def SetupFeatures(self):
+		""" create feature objects for all features from the detection results """
+		try:
+			rectList = self.featureFuture.result()
+		except Exception:
+			print("feature detection failed, using the head guide")
+			traceback.print_exc(file=sys.stdout)
+			rectList = None
+		if rectList is None:
+			rectList = [convertRect_image2screen(defaultFeatureRects[label]) for label in ['left eye', 'right eye', 'mouth']]
+
+		self.leftEye = FacialFeature("left eye", rectList[0])
+		self.rightEye = FacialFeature("right eye", rectList[1])
+		self.mouth = FacialFeature("mouth", rectList[2])
+		self.featureList = [self.leftEye, self.rightEye, self.mouth]
+		self.currentFeature = self.featureList[self.featureIndex]
+
 	def ProcessInput(self, eventList):
+		# nothing to confirm until the features are ready
+		if self.featureList is None:
+			return
+
 		# send events to the buttons and features
 		for event in eventList:
 
@@ -415,6 +487,12 @@ class thatchConfirmFeatures(StateBase):
 			self.currentFeature.handleEvent(event)
 
 	def Update(self):
+		# pick up the detected features once they're ready
+		if self.featureList is None:
+			if not self.featureFuture.done():
+				return
+			self.SetupFeatures()
+
 		# update the current feature parameters
 		if self.featureIndex < len(self.featureList):
 			self.currentFeature = self.featureList[self.featureIndex]
@@ -434,7 +512,8 @@ class thatchConfirmFeatures(StateBase):
 		screen.blit(self.cameraImg, (centerX-(viewerSize[0]/2), centerY-(viewerSize[1]/2)), self.cropRect)
 
 		# draw the rectangle for the current feature
-		pygame.draw.rect(screen, self.currentFeature.color, self.currentRect, 3)
+		if self.featureList is not None:
+			pygame.draw.rect(screen, self.currentFeature.color, self.currentRect, 3)
 
 		# draw the current feature label text
 		screen.blit(self.textSurf, self.textRect)
@@ -699,6 +778,49 @@ def get_lastFileNumber():
 	return str(int(fileNum)).zfill(3)
 
 
+def detectFeatureRects(cameraFrame, cancelEvent):
+	""" 
+	detect the eyes and mouth in the camera frame (runs on detectionPool)
+	return [left eye, right eye, mouth] rects in SCREEN COORDINATES, or None if cancelled
+	"""
+	if cancelEvent.is_set():
+		return None
+
+	featureDetector = FeatureRecognition(cameraFrame)					# create featureDetection object with this frame
+	eyeRects, mouthRect = featureDetector.detectFeatures()				# find the face, then the eyes and mouth in it
+	print("feature detection: " + ", ".join(["%s %.1fms" % (k, v*1000) for k, v in sorted(featureDetector.timings.items())]))
+	if cancelEvent.is_set():
+		return None
+
+	return [convertRect_image2screen(r) for r in eyeRects + [mouthRect]]
+
+
+def readCameraFrame(afterSeq):
+	""" return (seq, frame) of the newest camera frame if it's newer than afterSeq, otherwise None (never waits) """
+	latest = camStream.read_latest(afterSeq, timeout=0)
+	if latest is None:
+		return None
+	return latest[0], latest[2]
+
+
+def drawTrackedFeatures(screen):
+	""" draw the currently tracked feature rects over the viewer (yellow once the track is stable) """
+	trackedRects = featureTracker.get_rects()
+	if trackedRects is None:
+		return
+	
+	if featureTracker.get_stableRects() is not None:
+		rectColor = yellow
+	else:
+		rectColor = ltBlue
+
+	# keep the rects inside the viewer
+	screen.set_clip(pygame.Rect(centerX-(viewerSize[0]/2), centerY-(viewerSize[1]/2), viewerSize[0], viewerSize[1]))
+	for r in trackedRects:
+		pygame.draw.rect(screen, rectColor, convertRect_image2screen(r), 2)
+	screen.set_clip(None)
+
+
 def convertRect_screen2image(Rect):
 	""" convert the supplied screen rect to image coordinates """
 	
@@ -737,72 +859,35 @@ def thatcherizePhoto(imgArray, rectList):
 	""" 
 	for each rectangle in the supplied rectList, crop, flip, and alpha mask, and save
 		- input rectangles are in SCREEN COORDINATES
-		- input imgArray is converted to PIL Image type
+		- input imgArray is the camera frame (mirrored to match the screen before thatcherizing)
 	"""
-	# convert the input imgArray to PIL type
-	imgOrig = Image.fromarray(np.fliplr(imgArray))
-	imgThatch = imgOrig.copy()			# create a copy that will be thatcherized
-
-	# loop through each Rect (L.eye, R.eye, Mouth):
-	for r in rectList:
-		# convert rect to image coordinates
-		cr = convertRect_screen2image(r)
-		cr_w = cr[2]			# width, for clarity later
-		cr_h = cr[3]			# height, for clarity later
-
-		# resize the mask to fit the current rectangle
-		resizedMask = mask.resize((cr[2], cr[3]))
+	# convert the rects to image coordinates
+	imgRects = [convertRect_screen2image(r) for r in rectList]
 
-		# crop rect out of original image 
-		imgCrop = imgThatch.crop((cr[0], cr[1], cr[0]+cr_w, cr[1]+cr_h))
+	# thatcherize the mirrored frame, then crop both to be a 360x480 (w,h) rect around the face
+	imgMirrored = np.fliplr(imgArray)
+	imgOrig = engine.cropFace(imgMirrored)
+	imgThatch = engine.cropFace(engine.thatcherize(imgMirrored, imgRects))
 
-		# paste flipped version fo imgCrop back into the original, using the resized alpha mask
-		imgThatch.paste(imgCrop.transpose(Image.FLIP_TOP_BOTTOM), (cr[0], cr[1]), resizedMask)
-
-	# crop these images to be a 360x480 (w,h) rect around the face
-	cropBox = (140,0,500,480)
-	imgOrig = imgOrig.crop(cropBox)		
-	imgThatch = imgThatch.crop(cropBox)
-
-	# save the original and thatcherized images, as well as the final assembled print
+	# save the original and thatcherized images
 	lastFileNumber = get_lastFileNumber()	# get the base name to use for these images
 	currentFileNumber = str(int(lastFileNumber)+1).zfill(3)
 	fname = ("img_" + currentFileNumber)
 	
-	imgOrig.save(join(outputDir, (fname + "_orig.png")))
-	imgThatch.save(join(outputDir, (fname + "_thatch.png")))
+	Image.fromarray(imgOrig).save(join(outputDir, (fname + "_orig.png")))
+	Image.fromarray(imgThatch).save(join(outputDir, (fname + "_thatch.png")))
 
 	# return the orig and thatcherized as arrays
-	return np.fliplr(np.array(imgOrig)), np.fliplr(np.array(imgThatch))
+	return np.fliplr(imgOrig), np.fliplr(imgThatch)
 
 def assembleCompositeImage(imgOrigArray, imgThatchArray):
 	""" 
 	Crop the original and thatcherized, and place in proper locaton on the print template. 
 	save the final assembled composite. 
 
-	inputs: PIL image format for both original and thatcherized image.
+	inputs: orig and thatcherized arrays, as returned by thatcherizePhoto
 	"""
-
-	# convert the arrays to PIL image type
-	imgOrig = Image.fromarray(np.fliplr(imgOrigArray))
-	imgThatch = Image.fromarray(np.fliplr(imgThatchArray))
-
-	# scale the images up for the high-res print template file
-	imgOrig = imgOrig.resize((720, 960))
-	imgThatch = imgThatch.resize((720, 960))
-
-	# crop to 640x428 (w,h). This is a 320x426 crop of the original resolution
-	cropBox = (40, 52, 680, 908)	# (x1, y1, x2, y2) of the crop. 
-	imgOrig = imgOrig.crop(cropBox)
-	imgThatch = imgThatch.crop(cropBox)
-
-	# rotate the thatcherized 
-	imgThatch = imgThatch.rotate(180)
-
-	# place into print template
-	printTemplate = Image.open(join(stimsDir, "printTemplates", "printTemplate.png"))
-	printTemplate.paste(imgOrig, (58,172))
-	printTemplate.paste(imgThatch, (1102,172))
+	printTemplate = Image.fromarray(engine.assembleComposite(np.fliplr(imgOrigArray), np.fliplr(imgThatchArray)))
 
 	# save
 	fname =  "img_" + get_lastFileNumber() + "_composite.png"
@@ -827,7 +912,21 @@ def printComposite():
 
 
 ### Run the App, starting with the Intro ##################################
-run_thatcherizer(width, height, fps, thatchIntro())
+if __name__ == '__main__':
+	# load the feature classifiers up front (on the detection thread too), so detection doesn't pay for it mid-session
+	detectionPool.submit(getCascadeRegistry().preload)
+
+	# start the live feature tracker
+	if useTracking:
+		featureTracker = FeatureTracker(fps, trackEveryNthFrame, trackBudget).start()
+
+	# initialize camera
+	if len(sys.argv) > 1:
+		cameraSource = sys.argv[1]
+	camStream = makeCameraStream(cameraSource, camResolution, fps)
+	camStream.start()
+
+	run_thatcherizer(width, height, fps, thatchIntro())
 
 
 
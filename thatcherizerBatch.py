@@ -0,0 +1,106 @@
+"""
+Thatcherizer batch processing
+thatcherize a whole directory of photos offline, fanned out across a pool of worker processes
+
+usage: python thatcherizerBatch.py inputDir outputDir [--workers N] [--chunksize N]
+	- every photo gets its own <name>_orig.png, <name>_thatch.png, <name>_composite.png in outputDir
+	- photos are expected in IMAGE COORDINATES (i.e. as saved by the app, not raw camera frames)
+"""
+
+import sys
+import os
+import time
+import argparse
+import traceback
+import multiprocessing
+from os.path import join, splitext, basename, isdir
+import numpy as np
+import Image
+from thatcherizerEngine import ThatcherizerEngine
+from thatcherizerTools import FeatureRecognition, getCascadeRegistry
+
+imgExtensions = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# one engine per worker process (set up by initWorker)
+engine = None
+
+
+def initWorker():
+	""" load the engine and classifiers once per worker process, instead of once per photo """
+	global engine
+	engine = ThatcherizerEngine()
+	getCascadeRegistry()
+
+
+def processPhoto(job):
+	""" detect features, thatcherize, and save one photo; return (inputPath, error traceback or None) """
+	inputPath, outputDir = job
+	try:
+		imgArray = np.array(Image.open(inputPath).convert('RGB'))
+
+		# find the features (falls back to the head guide rects if nothing is found)
+		detector = FeatureRecognition(imgArray, flip=False)
+		eyeRects, mouthRect = detector.detectFeatures()
+		rectList = eyeRects + [mouthRect]
+
+		result = engine.process(imgArray, rectList)
+		result.save(outputDir, splitext(basename(inputPath))[0])
+		return inputPath, None
+	except Exception:
+		return inputPath, traceback.format_exc()
+
+
+def findPhotos(inputDir):
+	""" return sorted list of all image files in inputDir """
+	photos = []
+	for f in sorted(os.listdir(inputDir)):
+		if splitext(f)[1].lower() in imgExtensions:
+			photos.append(join(inputDir, f))
+	return photos
+
+
+def runBatch(inputDir, outputDir, nWorkers=None, chunksize=4):
+	""" thatcherize every photo in inputDir across nWorkers processes; return list of (path, traceback) failures """
+	if not isdir(outputDir): os.makedirs(outputDir)
+	photos = findPhotos(inputDir)
+	jobs = [(p, outputDir) for p in photos]
+	failures = []
+
+	startTime = time.time()
+	pool = multiprocessing.Pool(nWorkers, initWorker)
+	try:
+		for i, (inputPath, error) in enumerate(pool.imap_unordered(processPhoto, jobs, chunksize)):
+			if error is not None:
+				failures.append((inputPath, error))
+				print("FAILED: " + inputPath)
+			if (i+1) % 100 == 0:
+				print("processed %d/%d photos" % (i+1, len(jobs)))
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+	elapsed = time.time() - startTime
+	print("processed %d photos in %.1fs (%.2f photos/s), %d failed" % (len(jobs), elapsed, len(jobs)/max(elapsed, 1e-6), len(failures)))
+	return failures
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Thatcherize a directory of photos")
+	parser.add_argument('inputDir', help="directory of photos to thatcherize")
+	parser.add_argument('outputDir', help="directory to write the orig/thatch/composite images to")
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="number of worker processes (default: number of cores)")
+	parser.add_argument('--chunksize', type=int, default=4, help="photos handed to a worker at a time")
+	args = parser.parse_args(argv)
+
+	failures = runBatch(args.inputDir, args.outputDir, args.workers, args.chunksize)
+	for inputPath, error in failures:
+		print(inputPath)
+		print(error)
+	return 1 if failures else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Headless Thatcherizer engine
+thatcherize photos and assemble the print composite straight from image arrays;
+no display, camera, or app state required
+
+NOTE: all rects are (x,y,w,h) in IMAGE COORDINATES
+"""
+
+import os
+from os.path import join
+import numpy as np
+import Image
+
+##### CONFIG VARS ##########################################
+engineDir = os.path.abspath(os.path.dirname(__file__))
+stimsDir = join(engineDir, 'stims')
+
+faceAspectRatio = 0.75					# face crop is 3:4 (w,h); i.e. 360x480 on a 640x480 frame
+compositeScaleSize = (720, 960)			# size the face crops get scaled up to for the print template
+compositeCropBox = (40, 52, 680, 908)	# (x1, y1, x2, y2) crop of the scaled images
+origSlot = (58, 172)					# upper left corner of the original on the print template
+thatchSlot = (1102, 172)				# upper left corner of the thatcherized on the print template
+
+
+class ThatcherResult:
+	""" Container for the 3 images made from one photo (all numpy arrays) """
+	def __init__(self, origImg, thatchImg, compositeImg):
+		self.origImg = origImg
+		self.thatchImg = thatchImg
+		self.compositeImg = compositeImg
+
+	def save(self, outputDir, baseName):
+		""" save all 3 images as <baseName>_orig/_thatch/_composite.png; return list of paths """
+		paths = []
+		for suffix, img in [('_orig', self.origImg), ('_thatch', self.thatchImg), ('_composite', self.compositeImg)]:
+			path = join(outputDir, baseName + suffix + '.png')
+			Image.fromarray(img).save(path)
+			paths.append(path)
+		return paths
+
+
+class ThatcherizerEngine:
+	""" Thatcherize image arrays using feature rects in image coordinates """
+	def __init__(self, maskPath=None, templatePath=None):
+		""" load the alpha mask and locate the print template (default: the ones in stims/) """
+		if maskPath is None:
+			maskPath = join(stimsDir, 'alphaMask.png')
+		if templatePath is None:
+			templatePath = join(stimsDir, 'printTemplates', 'printTemplate.png')
+
+		self.mask = Image.open(maskPath)
+		self.mask.load()					# decode now, not on first use
+		self.templatePath = templatePath
+
+	def thatcherize(self, imgArray, rectList):
+		""" flip each rect upside down and blend it back in with the alpha mask; return new array """
+		imgThatch = Image.fromarray(imgArray)
+
+		# loop through each Rect (L.eye, R.eye, Mouth):
+		for (x, y, w, h) in rectList:
+			x, y, w, h = int(x), int(y), int(w), int(h)
+			if w <= 0 or h <= 0:
+				continue
+
+			# paste the flipped crop back in, using the alpha mask resized to this rect
+			resizedMask = self.mask.resize((w, h))
+			imgCrop = imgThatch.crop((x, y, x+w, y+h))
+			imgThatch.paste(imgCrop.transpose(Image.FLIP_TOP_BOTTOM), (x, y), resizedMask)
+
+		return np.array(imgThatch)
+
+	def faceCropBox(self, imgArray):
+		""" return the (x1, y1, x2, y2) 3:4 crop centered on the image (the head guide is centered) """
+		imgHeight, imgWidth = imgArray.shape[:2]
+		cropWidth = min(imgWidth, int(round(imgHeight * faceAspectRatio)))
+		x1 = (imgWidth - cropWidth) // 2
+		return (x1, 0, x1+cropWidth, imgHeight)
+
+	def cropFace(self, imgArray):
+		""" crop the image to the 3:4 rect around the face """
+		x1, y1, x2, y2 = self.faceCropBox(imgArray)
+		return imgArray[y1:y2, x1:x2]
+
+	def assembleComposite(self, origArray, thatchArray):
+		""" scale, crop, and place the (face cropped) orig and thatcherized images on the print template """
+		imgOrig = Image.fromarray(origArray).resize(compositeScaleSize).crop(compositeCropBox)
+		imgThatch = Image.fromarray(thatchArray).resize(compositeScaleSize).crop(compositeCropBox)
+
+		# the thatcherized goes on the print upside down
+		imgThatch = imgThatch.rotate(180)
+
+		printTemplate = Image.open(self.templatePath)
+		printTemplate.paste(imgOrig, origSlot)
+		printTemplate.paste(imgThatch, thatchSlot)
+		return np.array(printTemplate)
+
+	def process(self, imgArray, rectList):
+		""" thatcherize, face crop, and build the composite for a single photo; return ThatcherResult """
+		thatchArray = self.thatcherize(imgArray, rectList)
+		origCrop = np.ascontiguousarray(self.cropFace(imgArray))
+		thatchCrop = np.ascontiguousarray(self.cropFace(thatchArray))
+		composite = self.assembleComposite(origCrop, thatchCrop)
+		return ThatcherResult(origCrop, thatchCrop, composite)
@@ -7,27 +7,159 @@ Set of additional helper functions for running the Thatcherizer app
 import sys
 import os
 from os.path import join, split
-import picamera
-from picamera.array import PiRGBArray
+try:
+	import picamera
+	from picamera.array import PiRGBArray
+except ImportError:
+	picamera = None			# not running on a Pi (e.g. headless batch processing)
 import random
 import numpy as np
 import io
 import Image
 import cv2
 import time
+import math
+from collections import deque
+from Queue import Queue, Empty, Full
 import pygame
 from pygame.locals import *
-from threading import Thread
+from threading import Thread, Lock, Condition, local
 
+# classifiers live alongside this file, not in the current working dir
+classifierDir = join(os.path.abspath(os.path.dirname(__file__)), 'classifiers')
+cascadeFiles = {
+	'face': 'haarcascade_frontalface_default.xml',
+	'eye': 'haarcascade_eye.xml',
+	'mouth': 'haarcascade_mouth.xml'}
+
+# (min, max) feature sizes (w,h) to search for, based on the head guide [IMAGE COORDINATES, 480px tall frame]
+faceSizeRange = ((100, 100), (360, 360))
+eyeSizeRange = ((20, 20), (80, 80))
+mouthSizeRange = ((40, 24), (150, 90))
+
+# default (x,y,w,h) locations for feature rects (based on head guide) [IMAGE COORDINATES]
+defaultFeatureRects = {
+	'left eye': (240, 155, 50, 30),
+	'right eye': (345, 155, 50, 30),
+	'mouth': (275, 255, 90, 60)}
 
 
 ###################### INTERACT WITH CAMERA #############################
-class PiCamStream:
+class FrameRing:
+	""" Small ring of preallocated frame slots, filled by a capture thread; frames are tagged with a sequence # and timestamp """
+	def __init__(self, shape, nSlots=4, dtype=np.uint8):
+		""" 
+		- shape: (height, width, 3) of the frames
+		- nSlots: # of frames kept; a frame returned by read_latest stays untouched until nSlots-1 newer frames are written
+		"""
+		self.slots = [np.zeros(shape, dtype) for i in range(nSlots)]
+		self.slotSeqs = [0]*nSlots
+		self.slotTimes = [0.0]*nSlots
+		self.latestSeq = 0				# seq # of the newest frame (first frame is 1)
+		self.condition = Condition()
+
+		# counters
+		self.writtenFrames = 0
+		self.skippedFrames = 0			# frames that were overwritten without ever being read
+
+	def write(self, frame, timestamp=None):
+		""" copy frame into the next slot and publish it """
+		if timestamp is None:
+			timestamp = time.time()
+		seq = self.latestSeq + 1
+		idx = seq % len(self.slots)
+
+		# the slot being written is the oldest one, so readers of the newest frame aren't affected
+		if frame.shape != self.slots[idx].shape:
+			self.slots[idx] = np.empty(frame.shape, frame.dtype)
+		np.copyto(self.slots[idx], frame)
+
+		with self.condition:
+			self.slotSeqs[idx] = seq
+			self.slotTimes[idx] = timestamp
+			self.latestSeq = seq
+			self.writtenFrames += 1
+			self.condition.notify_all()
+
+	def read_latest(self, afterSeq=0, timeout=None):
+		""" 
+		return (seq, timestamp, frame) for the newest frame, waiting for one newer than afterSeq
+			- timeout: secs to wait (None waits forever, 0 doesn't wait); returns None if no new frame showed up
+			- frame is a view into the ring; copy it (or use snapshot) if you need to hold on to it
+		"""
+		with self.condition:
+			if self.latestSeq <= afterSeq:
+				if timeout == 0:
+					return None
+				endTime = None if timeout is None else time.time() + timeout
+				while self.latestSeq <= afterSeq:
+					remaining = None if endTime is None else endTime - time.time()
+					if remaining is not None and remaining <= 0:
+						return None
+					self.condition.wait(remaining)
+
+			seq = self.latestSeq
+			if afterSeq > 0 and seq > afterSeq + 1:
+				self.skippedFrames += seq - afterSeq - 1
+			idx = seq % len(self.slots)
+			return seq, self.slotTimes[idx], self.slots[idx]
+
+	def snapshot(self, out=None):
+		""" return (seq, timestamp, copy of the newest frame); copies into out if supplied. Returns None if no frames yet """
+		with self.condition:
+			if self.latestSeq == 0:
+				return None
+			idx = self.latestSeq % len(self.slots)
+			if out is None:
+				out = self.slots[idx].copy()
+			else:
+				np.copyto(out, self.slots[idx])
+			return self.latestSeq, self.slotTimes[idx], out
+
+
+class CameraStream:
+	""" Base class for camera sources: a capture thread (update) fills a FrameRing with RGB frames """
+	def __init__(self, resolution, fps, nSlots=4):
+		self.resolution = resolution
+		self.fps = fps
+		self.frames = FrameRing((self.resolution[1], self.resolution[0], 3), nSlots)
+		self.stopped = False
+
+	def start(self):
+		""" start the thread to read frames from the video stream """
+		Thread(target=self.update, args=()).start()
+		return self
+
+	def update(self):
+		""" capture frames into self.frames til thread is stopped (define in each source) """
+		raise NotImplementedError
+
+	def read(self):
+		""" return the most recent frame (None if there isn't one yet) """
+		latest = self.frames.read_latest(0, timeout=0)
+		if latest is None:
+			return None
+		return latest[2]
+
+	def read_latest(self, afterSeq=0, timeout=None):
+		""" return (seq, timestamp, frame) of the newest frame after afterSeq (see FrameRing.read_latest) """
+		return self.frames.read_latest(afterSeq, timeout)
+
+	def snapshot(self, out=None):
+		""" return (seq, timestamp, frame) with a copy of the newest frame (see FrameRing.snapshot) """
+		return self.frames.snapshot(out)
+	
+	def stop(self):
+		""" stop the thread """
+		self.stopped = True
+
+
+class PiCamStream(CameraStream):
 	""" Class for interacting with the Pi Camera stream """
-	def __init__(self, resolution, fps):
+	def __init__(self, resolution, fps, nSlots=4):
 		""" initialize the camera """
+		CameraStream.__init__(self, resolution, fps, nSlots)
 
-		self.resolution = resolution
 		self.camera = picamera.PiCamera()
 		self.camera.framerate=fps
 		#self.camera.hflip=True
@@ -37,18 +169,10 @@ class PiCamStream:
 
 		self.stream = self.camera.capture_continuous(self.rawCapture, format="rgb", use_video_port=True)
 
-		self.frame = None
-		self.stopped = False
-
-	def start(self):
-		""" start the thread to read frames from the video stream """
-		Thread(target=self.update, args=()).start()
-		return self
-
 	def update(self):
 		""" keep looping til thread is stopped """
 		for f in self.stream:
-			self.frame = f.array
+			self.frames.write(f.array)
 			self.rawCapture.truncate(0)		# clear the stream
 
 			if self.stopped:
@@ -57,39 +181,228 @@ class PiCamStream:
 				self.camera.close()
 				return
 
-	def read(self):
-		""" return the most recent frame """
-		return self.frame
-	
-	def stop(self):
-		""" stop the thread """
-		self.stopped = True
+
+class OpenCVCamStream(CameraStream):
+	""" Class for reading a V4L2/USB camera through OpenCV """
+	def __init__(self, resolution, fps, device=0, nSlots=4):
+		""" open the camera device (index, or path like /dev/video0) """
+		CameraStream.__init__(self, resolution, fps, nSlots)
+
+		self.capture = cv2.VideoCapture(device)
+		if not self.capture.isOpened():
+			raise IOError("could not open camera device: " + str(device))
+		self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+		self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+		self.capture.set(cv2.CAP_PROP_FPS, fps)
+		self.rgbFrame = None			# reused buffer for the BGR->RGB conversion
+
+	def update(self):
+		""" keep looping til thread is stopped """
+		while not self.stopped:
+			grabbed, bgrFrame = self.capture.read()
+			if not grabbed:
+				time.sleep(0.01)
+				continue
+			self.rgbFrame = cv2.cvtColor(bgrFrame, cv2.COLOR_BGR2RGB, self.rgbFrame)
+			self.frames.write(self.rgbFrame)
+		self.capture.release()
+
+
+class ReplayCamStream(CameraStream):
+	""" Class for replaying a directory of images, or a video file, as if it were a camera (for testing/profiling) """
+	def __init__(self, resolution, fps, source, loop=True, nSlots=4):
+		""" 
+		- source: directory of images (played in sorted order) or a video file
+		- fps: replay rate; None replays as fast as frames can be decoded
+		- loop: start over at the end, instead of stopping
+		"""
+		CameraStream.__init__(self, resolution, fps, nSlots)
+		self.source = source
+		self.loop = loop
+
+		if os.path.isdir(source):
+			imgExtensions = ('.png', '.jpg', '.jpeg', '.bmp')
+			fileNames = sorted([f for f in os.listdir(source) if os.path.splitext(f)[1].lower() in imgExtensions])
+			if len(fileNames) == 0:
+				raise IOError("no images to replay in: " + source)
+
+			# decode everything up front, so replay isn't limited by disk/decoding
+			self.images = [self.fitFrame(cv2.imread(join(source, f))) for f in fileNames]
+			self.video = None
+		else:
+			self.video = cv2.VideoCapture(source)
+			if not self.video.isOpened():
+				raise IOError("could not open video: " + source)
+			self.images = None
+
+	def fitFrame(self, bgrFrame):
+		""" convert a decoded BGR frame to an RGB frame at the camera resolution """
+		if (bgrFrame.shape[1], bgrFrame.shape[0]) != tuple(self.resolution):
+			bgrFrame = cv2.resize(bgrFrame, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+		return cv2.cvtColor(bgrFrame, cv2.COLOR_BGR2RGB)
+
+	def nextFrame(self, frameNum):
+		""" return the next frame to replay, or None at the end """
+		if self.images is not None:
+			if frameNum >= len(self.images) and not self.loop:
+				return None
+			return self.images[frameNum % len(self.images)]
+
+		grabbed, bgrFrame = self.video.read()
+		if not grabbed and self.loop:
+			self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			grabbed, bgrFrame = self.video.read()
+		if not grabbed:
+			return None
+		return self.fitFrame(bgrFrame)
+
+	def update(self):
+		""" keep replaying til the end (or til thread is stopped) """
+		frameNum = 0
+		nextTime = time.time()
+		while not self.stopped:
+			frame = self.nextFrame(frameNum)
+			if frame is None:
+				break
+
+			# hold each frame for 1/fps secs (unless unthrottled)
+			if self.fps:
+				nextTime += 1.0/self.fps
+				delay = nextTime - time.time()
+				if delay > 0:
+					time.sleep(delay)
+				elif delay < -1.0/self.fps:
+					nextTime = time.time()		# fell behind; don't try to catch up
+			self.frames.write(frame)
+			frameNum += 1
+
+		if self.video is not None:
+			self.video.release()
+
+
+def makeCameraStream(source, resolution, fps):
+	""" 
+	create the camera stream for source:
+		- 'picamera': the Pi camera
+		- 'opencv' or 'opencv:<device>': a V4L2/USB camera (device index or path, default 0)
+		- anything else: path to a directory of images or a video file to replay at fps
+	"""
+	if source == 'picamera':
+		return PiCamStream(resolution, fps)
+	elif source.startswith('opencv'):
+		device = source.partition(':')[2] or '0'
+		if device.isdigit():
+			device = int(device)
+		return OpenCVCamStream(resolution, fps, device)
+	else:
+		return ReplayCamStream(resolution, fps, source)
+
+
+###################### CAMERA PREVIEW #############################
+class CameraPreview:
+	""" Viewer-sized surface that camera frames get copied into (instead of making a new surface every frame) """
+	def __init__(self, windowSize):
+		# 24 bit, so the surface pixels can be written to directly, in the same layout as the camera frames
+		self.windowSize = windowSize
+		self.surface = pygame.Surface(windowSize, 0, 24)
+		self.cropRect = (0, 0, windowSize[0], windowSize[1])
+
+	def update(self, frame):
+		""" copy the (mirrored) window centered on the frame into the preview surface """
+		# crop Rect (x1, y1, width, height) of the window, same as cropImage on the full frame surface
+		frameHeight, frameWidth = frame.shape[:2]
+		x1 = (frameWidth - self.windowSize[0])//2
+		y1 = (frameHeight - self.windowSize[1])//2
+		self.cropRect = (x1, y1, self.windowSize[0], self.windowSize[1])
+
+		# frames are (rows, cols) and the screen is mirrored; surface pixels are (x, y). All views, no copies
+		window = frame[:, ::-1][y1:y1+self.windowSize[1], x1:x1+self.windowSize[0]]
+		pixels = pygame.surfarray.pixels3d(self.surface)
+		pixels[...] = window.swapaxes(0, 1)
+		del pixels						# unlock the surface so it can be blitted
 
 
 ###################### DETECT FACIAL FEATURES #############################
+class CascadeRegistry:
+	""" Load and validate the Haar cascades once; hand out ready classifiers (one set per thread) """
+	def __init__(self, classifierDir=classifierDir, cascadeFiles=cascadeFiles):
+		""" check all cascade files exist, and parse them for the calling thread """
+		self.classifierDir = classifierDir
+		if not os.path.isdir(self.classifierDir):
+			raise IOError("classifier directory not found: " + self.classifierDir)
+
+		self.cascadePaths = {}
+		for name, fname in cascadeFiles.items():
+			self.cascadePaths[name] = join(self.classifierDir, fname)
+			if not os.path.isfile(self.cascadePaths[name]):
+				raise IOError("classifier file not found: " + self.cascadePaths[name])
+
+		# classifiers aren't safe to share between threads, so each thread gets its own set
+		self.threadCascades = local()
+		self.preload()
+
+	def preload(self):
+		""" load all classifiers for the calling thread (e.g. to warm up a worker thread) """
+		for name in self.cascadePaths:
+			self.get(name)
+
+	def loadCascade(self, name):
+		""" parse the cascade XML from disk """
+		cascade = cv2.CascadeClassifier(self.cascadePaths[name])
+		if cascade.empty():
+			raise IOError("could not load classifier: " + self.cascadePaths[name])
+		return cascade
+
+	def get(self, name):
+		""" return the named ('face', 'eye', 'mouth') classifier for the calling thread """
+		cascades = getattr(self.threadCascades, 'cascades', None)
+		if cascades is None:
+			cascades = self.threadCascades.cascades = {}
+		if name not in cascades:
+			cascades[name] = self.loadCascade(name)
+		return cascades[name]
+
+
+# process-wide registry (see getCascadeRegistry)
+cascadeRegistry = None
+cascadeRegistryLock = Lock()
+
+def getCascadeRegistry():
+	""" return the shared CascadeRegistry, loading it on first use """
+	global cascadeRegistry
+	with cascadeRegistryLock:
+		if cascadeRegistry is None:
+			cascadeRegistry = CascadeRegistry()
+	return cascadeRegistry
+
+
 class FeatureRecognition:
 	""" Detect Eyes/Mouth on the the supplied imgArray """
-	def __init__(self, imgArray):
-		""" input imgArray: (height, width) """
+	def __init__(self, imgArray, flip=True, registry=None):
+		""" 
+		input imgArray: (height, width)
+			- flip: mirror the array first (camera frames). Set False if imgArray is already in IMAGE COORDINATES
+			- registry: CascadeRegistry to get classifiers from (default: the shared one)
+		"""
 
 		# load in array (needs to be in (nRows, nCols) format; not (width, height))
 		self.imgArray = imgArray
-		self.imgArray = np.fliplr(self.imgArray)
+		if flip:
+			self.imgArray = np.fliplr(self.imgArray)
 		self.imgCenterX, self.imgCenterY = self.imgArray.shape[1]/2, self.imgArray.shape[0]/2
 		self.imgArrayGray = cv2.cvtColor(self.imgArray, cv2.COLOR_RGB2GRAY)	# convert to grayscale
 
 		# set default (x,y,w,h) locations for feature rects (based on head guide) [IMAGE COORDINATES]
-		self.leftEyeRect = (240, 155, 50, 30)
-		self.rightEyeRect = (345, 155, 50, 30)
-		self.mouthRect = (275, 255, 90, 60)
-
-		# load in classifiers
-		self.classifierDir = (join(os.getcwd(), 'classifiers'))
-		if not os.path.isdir(self.classifierDir): 
-			print ("you screwed up the classifier directory path, dude")
-		self.face_cascade = cv2.CascadeClassifier(join(self.classifierDir, 'haarcascade_frontalface_default.xml'))
-		self.eye_cascade = cv2.CascadeClassifier(join(self.classifierDir, "haarcascade_eye.xml"))
-		self.mouth_cascade = cv2.CascadeClassifier(join(self.classifierDir, "haarcascade_mouth.xml"))
+		self.leftEyeRect = defaultFeatureRects['left eye']
+		self.rightEyeRect = defaultFeatureRects['right eye']
+		self.mouthRect = defaultFeatureRects['mouth']
+
+		# get the preloaded classifiers
+		if registry is None:
+			registry = getCascadeRegistry()
+		self.face_cascade = registry.get('face')
+		self.eye_cascade = registry.get('eye')
+		self.mouth_cascade = registry.get('mouth')
 
 	def detectEyes(self):
 		""" find the eyes; return list of eyeRect tuples [image coordinates] """
@@ -101,7 +414,7 @@ class FeatureRecognition:
 		if len(self.eyeRects) > 0:
 			print "Found " + str(len(self.eyeRects)) + " Eyes!"
 			# limit to only two eyes
-			if len(self.eyeRects) > 2: self.eyeRects[:2]
+			if len(self.eyeRects) > 2: self.eyeRects = self.eyeRects[:2]
 
 			# loop through all eyes
 			for (self.x,self.y,self.w,self.h) in self.eyeRects:
@@ -150,6 +463,238 @@ class FeatureRecognition:
 		# return (x,y,w,h) tuple describing the mouth rect
 		return self.mouthRect
 
+	def detectFeatures(self, faceScale=0.5, fallback=True):
+		""" 
+		face-first detection: find the face (on an image downscaled by faceScale), then search for 
+		the eyes in the upper part of the face and the mouth in the lower part only. Falls back to
+		the full-frame detectEyes/detectMouth if no face is found (unless fallback=False).
+
+		returns (eyeRects, mouthRect) [image coordinates]; per-stage timings (secs) are stored in self.timings,
+		and which features were actually found (vs. left at their defaults) in self.foundFeatures
+		"""
+		self.timings = {}
+		self.foundFeatures = {'left eye': False, 'right eye': False, 'mouth': False}
+		startTime = time.time()
+
+		# scale the expected feature sizes to this image
+		self.sizeScale = self.imgArrayGray.shape[0]/480.0
+
+		# find the face
+		stageTime = time.time()
+		self.faceRect = self.detectFace(faceScale)
+		self.timings['face'] = time.time() - stageTime
+
+		if self.faceRect is None:
+			if not fallback:
+				self.timings['total'] = time.time() - startTime
+				return [self.leftEyeRect, self.rightEyeRect], self.mouthRect
+
+			print("No face found, searching the full frame")
+			stageTime = time.time()
+			self.detectEyes()
+			self.timings['eyes'] = time.time() - stageTime
+
+			stageTime = time.time()
+			self.detectMouth()
+			self.timings['mouth'] = time.time() - stageTime
+		else:
+			fx, fy, fw, fh = self.faceRect
+
+			# eyes: upper part of the face only
+			stageTime = time.time()
+			eyeRoi = (fx, fy + int(fh*0.15), fw, int(fh*0.45))
+			eyeRects = self.detectInRoi(self.eye_cascade, eyeRoi, eyeSizeRange)
+			eyeRects = sorted(eyeRects, key=lambda r: r[2]*r[3], reverse=True)[:2]		# keep the 2 biggest
+			for eyeRect in eyeRects:
+				# figure out which side of the face it's on
+				trimmedRect = self.trimEyeRect(eyeRect)
+				if eyeRect[0] + eyeRect[2]/2 <= fx + fw/2:
+					self.leftEyeRect = trimmedRect
+					self.foundFeatures['left eye'] = True
+				else:
+					self.rightEyeRect = trimmedRect
+					self.foundFeatures['right eye'] = True
+			self.timings['eyes'] = time.time() - stageTime
+
+			# mouth: lower part of the face (haar face boxes often cut off the chin)
+			stageTime = time.time()
+			mouthRoi = (fx, fy + int(fh*0.6), fw, int(fh*0.55))
+			mouthRects = self.detectInRoi(self.mouth_cascade, mouthRoi, mouthSizeRange)
+			if len(mouthRects) > 0:
+				self.mouthRect = max(mouthRects, key=lambda r: r[2]*r[3])
+				self.foundFeatures['mouth'] = True
+			self.timings['mouth'] = time.time() - stageTime
+
+		self.timings['total'] = time.time() - startTime
+
+		# return list of (x,y,w,h) tuples describing the left and right eyes, and the mouth rect
+		self.eyeRects = [self.leftEyeRect, self.rightEyeRect]
+		return self.eyeRects, self.mouthRect
+
+	def detectFace(self, faceScale=0.5):
+		""" find the biggest face on a downscaled copy of the image; return face rect [image coordinates] or None """
+		if faceScale != 1:
+			smallGray = cv2.resize(self.imgArrayGray, None, fx=faceScale, fy=faceScale, interpolation=cv2.INTER_AREA)
+		else:
+			smallGray = self.imgArrayGray
+
+		minSize, maxSize = [(int(w*self.sizeScale*faceScale), int(h*self.sizeScale*faceScale)) for (w, h) in faceSizeRange]
+		faceRects = self.face_cascade.detectMultiScale(smallGray, 1.2, 4, minSize=minSize, maxSize=maxSize)
+		if len(faceRects) == 0:
+			return None
+
+		# scale the biggest face back up to full size
+		x, y, w, h = max(faceRects, key=lambda r: r[2]*r[3])
+		return tuple([int(v/faceScale) for v in (x, y, w, h)])
+
+	def detectInRoi(self, cascade, roi, sizeRange):
+		""" run the cascade on the (x,y,w,h) roi only; return list of rects [image coordinates] """
+		x, y, w, h = roi
+		imgHeight, imgWidth = self.imgArrayGray.shape[:2]
+		x1, y1 = max(x, 0), max(y, 0)
+		x2, y2 = min(x+w, imgWidth), min(y+h, imgHeight)
+		if x2 <= x1 or y2 <= y1:
+			return []
+
+		minSize, maxSize = [(int(sw*self.sizeScale), int(sh*self.sizeScale)) for (sw, sh) in sizeRange]
+		rects = cascade.detectMultiScale(self.imgArrayGray[y1:y2, x1:x2], 1.1, 3, minSize=minSize, maxSize=maxSize)
+
+		# shift back to image coordinates
+		return [(rx+x1, ry+y1, rw, rh) for (rx, ry, rw, rh) in rects]
+
+	def trimEyeRect(self, eyeRect):
+		""" eye detections are square; trim the height so the Rect is wider than tall """
+		x, y, w, h = eyeRect
+		eyeRectAspectRatio = 1.7		# factor by which the Rect is wider than tall
+		h = int(w/eyeRectAspectRatio)
+		y = y + ((w-h)/2)
+		return (x, y, w, h)
+
+
+class FeatureTracker:
+	""" Track the eyes/mouth on live camera frames in a background thread """
+	def __init__(self, fps, everyNthFrame=3, budget=0.5, smoothing=0.5, stableDetections=3, stableDistance=8):
+		""" 
+		- fps: preview frame rate the tracker has to keep up with
+		- everyNthFrame: run detection on (at most) every Nth submitted frame
+		- budget: max fraction of the frame interval the detector may use on average; 
+			everyNthFrame is raised automatically if detection is slower than that
+		- smoothing: weight of each new detection in the running average of the rects (0-1)
+		- stableDetections, stableDistance: # of detections in a row that moved less than 
+			stableDistance (px) before the track counts as stable
+		"""
+		self.fps = fps
+		self.minEveryNthFrame = everyNthFrame
+		self.everyNthFrame = everyNthFrame
+		self.budget = budget
+		self.smoothing = smoothing
+		self.stableDetections = stableDetections
+		self.stableDistance = stableDistance
+		self.labels = ['left eye', 'right eye', 'mouth']
+
+		# only ever hold 1 frame; if the worker is still busy, newer frames replace it
+		self.frameQueue = Queue(maxsize=1)
+		self.detectionTimes = deque(maxlen=10)
+		self.lock = Lock()
+		self.reset()
+		self.stopped = False
+
+	def reset(self):
+		""" forget the current track (e.g. new guest) """
+		with self.lock:
+			self.trackedRects = {}			# smoothed rects for each label [IMAGE COORDINATES]
+			self.stableCount = 0
+		self.frameCount = 0
+		self.skippedFrames = 0
+
+	def start(self):
+		""" start the thread to run detection on submitted frames """
+		t = Thread(target=self.update, args=())
+		t.daemon = True
+		t.start()
+		return self
+
+	def submit(self, frame):
+		""" offer a camera frame to the tracker (never blocks; frames are skipped if the worker is busy) """
+		self.frameCount += 1
+		if frame is None or self.frameCount % self.everyNthFrame != 0:
+			return
+		frame = frame.copy()				# camera frames live in a ring buffer that gets reused
+
+		try:
+			self.frameQueue.put_nowait(frame)
+		except Full:
+			# swap the stale frame for this one
+			try:
+				self.frameQueue.get_nowait()
+			except Empty:
+				pass
+			try:
+				self.frameQueue.put_nowait(frame)
+			except Full:
+				pass
+			self.skippedFrames += 1
+
+	def update(self):
+		""" keep detecting on the latest submitted frame til thread is stopped """
+		while not self.stopped:
+			try:
+				frame = self.frameQueue.get(timeout=0.2)
+			except Empty:
+				continue
+
+			detector = FeatureRecognition(frame)
+			eyeRects, mouthRect = detector.detectFeatures(fallback=False)
+			self.updateTrack(dict(zip(self.labels, eyeRects + [mouthRect])), detector.foundFeatures)
+			self.updateBudget(detector.timings['total'])
+
+	def updateTrack(self, rects, found):
+		""" fold the detected rects into the smoothed track """
+		with self.lock:
+			if not all(found.values()):
+				self.stableCount = 0
+			else:
+				maxMove = 0
+				for label in self.labels:
+					newRect = [float(v) for v in rects[label]]
+					if label in self.trackedRects:
+						oldRect = self.trackedRects[label]
+						maxMove = max(maxMove, max([abs(n-o) for n, o in zip(newRect, oldRect)]))
+						newRect = [self.smoothing*n + (1-self.smoothing)*o for n, o in zip(newRect, oldRect)]
+					else:
+						maxMove = float('inf')
+					self.trackedRects[label] = newRect
+
+				if maxMove < self.stableDistance:
+					self.stableCount += 1
+				else:
+					self.stableCount = 0
+
+	def updateBudget(self, detectionTime):
+		""" detect less often if detection is using more than its share of each frame """
+		self.detectionTimes.append(detectionTime)
+		avgTime = sum(self.detectionTimes)/len(self.detectionTimes)
+		self.everyNthFrame = max(self.minEveryNthFrame, int(math.ceil(avgTime*self.fps/self.budget)))
+
+	def get_rects(self):
+		""" return the current smoothed [left eye, right eye, mouth] rects [IMAGE COORDINATES], or None """
+		with self.lock:
+			if len(self.trackedRects) < len(self.labels):
+				return None
+			return [tuple([int(round(v)) for v in self.trackedRects[label]]) for label in self.labels]
+
+	def get_stableRects(self):
+		""" return the current rects only if the track is stable, otherwise None """
+		with self.lock:
+			isStable = self.stableCount >= self.stableDetections
+		if isStable:
+			return self.get_rects()
+		return None
+
+	def stop(self):
+		""" stop the thread """
+		self.stopped = True
+
 
 ###################### FACIAL FEATURE OBJECTS #############################
 class FacialFeature: